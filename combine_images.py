@@ -1,5 +1,6 @@
 import os
 import glob
+import numpy as np
 from PIL import Image
 
 # --- Configuration ---
@@ -17,11 +18,13 @@ def get_image_pairs(protein_pairs):
     return image_pairs
 
 def combine_pair_images(img1_path, img2_path):
-    img1 = Image.open(img1_path)
-    img2 = Image.open(img2_path)
-    dst = Image.new('RGB', (img1.width + img2.width, img1.height))
-    dst.paste(img1, (0, 0))
-    dst.paste(img2, (img1.width, 0))
+    """Places two images side by side in one preallocated (height, width, 3) uint8 array."""
+    img1 = np.asarray(Image.open(img1_path).convert('RGB'))
+    img2 = np.asarray(Image.open(img2_path).convert('RGB'))
+    height = img1.shape[0]
+    dst = np.zeros((height, img1.shape[1] + img2.shape[1], 3), dtype=np.uint8)
+    dst[:, :img1.shape[1]] = img1
+    dst[:min(height, img2.shape[0]), img1.shape[1]:] = img2[:height]
     return dst
 
 def main():
@@ -37,22 +40,22 @@ def main():
 
     # Create a grid
     # For simplicity, we'll just stack them vertically. A grid would be more complex.
-    max_width = max(img.width for img in combined_images)
-    total_height = sum(img.height for img in combined_images)
+    max_width = max(img.shape[1] for img in combined_images)
+    total_height = sum(img.shape[0] for img in combined_images)
 
-    grid_image = Image.new('RGB', (max_width, total_height))
+    grid = np.zeros((total_height, max_width, 3), dtype=np.uint8)
     y_offset = 0
     for img in combined_images:
-        grid_image.paste(img, (0, y_offset))
-        y_offset += img.height
+        grid[y_offset:y_offset + img.shape[0], :img.shape[1]] = img
+        y_offset += img.shape[0]
 
-    grid_image.save(OUTPUT_IMAGE)
+    Image.fromarray(grid).save(OUTPUT_IMAGE)
     print(f"Combined image saved to {OUTPUT_IMAGE}")
 
 if __name__ == "__main__":
     try:
         from PIL import Image
     except ImportError:
-        print("Pillow library not found. Please install it with: pip install Pillow")
+        print("Pillow library not found. Please install it with: pip install Pillow (or the drop-in, SIMD-accelerated pillow-simd)")
         exit(1)
     main()
@@ -1,5 +1,6 @@
 import os
 import glob
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 # --- Configuration ---
@@ -22,25 +23,23 @@ def create_labeled_pair_image(pdb_pair, image_paths, font):
     pdb1, pdb2 = pdb_pair
     img1_path, img2_path = image_paths
 
-    img1 = Image.open(img1_path)
-    img2 = Image.open(img2_path)
+    img1 = np.asarray(Image.open(img1_path).convert('RGB'))
+    img2 = np.asarray(Image.open(img2_path).convert('RGB'))
+    height, width1 = img1.shape[:2]
 
-    # Create a new image with space for labels
+    # Create a white buffer with space for labels and copy both images into it
     label_height = FONT_SIZE + 10
-    new_width = img1.width + img2.width
-    new_height = img1.height + label_height
-    pair_image = Image.new('RGB', (new_width, new_height), 'white')
-
-    # Paste the images
-    pair_image.paste(img1, (0, label_height))
-    pair_image.paste(img2, (img1.width, label_height))
+    pair_array = np.full((height + label_height, width1 + img2.shape[1], 3), 255, dtype=np.uint8)
+    pair_array[label_height:, :width1] = img1
+    pair_array[label_height:label_height + min(height, img2.shape[0]), width1:] = img2[:height]
+    pair_image = Image.fromarray(pair_array)
 
     # Add labels
     draw = ImageDraw.Draw(pair_image)
     label1 = f"{pdb1} vs {pdb2} (LieOTAlign)"
     label2 = f"{pdb1} vs {pdb2} (Official)"
     draw.text((10, 5), label1, font=font, fill='black')
-    draw.text((img1.width + 10, 5), label2, font=font, fill='black')
+    draw.text((width1 + 10, 5), label2, font=font, fill='black')
 
     return pair_image
 
@@ -72,22 +71,23 @@ def main():
     max_width = labeled_images[0].width * IMAGES_PER_ROW
     max_height = labeled_images[0].height * num_rows
 
-    grid_image = Image.new('RGB', (max_width, max_height), 'white')
+    grid = np.full((max_height, max_width, 3), 255, dtype=np.uint8)
 
     for i, img in enumerate(labeled_images):
         row = i // IMAGES_PER_ROW
         col = i % IMAGES_PER_ROW
         x_offset = col * img.width
         y_offset = row * img.height
-        grid_image.paste(img, (x_offset, y_offset))
+        tile = np.asarray(img)[:max_height - y_offset, :max_width - x_offset]
+        grid[y_offset:y_offset + tile.shape[0], x_offset:x_offset + tile.shape[1]] = tile
 
-    grid_image.save(OUTPUT_IMAGE)
+    Image.fromarray(grid).save(OUTPUT_IMAGE)
     print(f"Combined image saved to {OUTPUT_IMAGE}")
 
 if __name__ == "__main__":
     try:
         from PIL import Image, ImageDraw, ImageFont
     except ImportError:
-        print("Pillow library not found. Please install it with: pip install Pillow")
+        print("Pillow library not found. Please install it with: pip install Pillow (or the drop-in, SIMD-accelerated pillow-simd)")
         exit(1)
     main()
\ No newline at end of file
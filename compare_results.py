@@ -1,6 +1,22 @@
+import io
 import os
 import re
-import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Each log is scanned once with a single alternation; the named group that matched tells which field was found.
+_GEMINI_LOG_RE = re.compile(
+    r"Found (?P<len>\d+) residue pairs"
+    r"|Kabsch RMSD.*?=\s*(?P<rmsd>[\d\.]+)"
+    r"|Standard TM-score \(normalized by mobile.*?=\s*(?P<tm1>[\d\.]+)$"
+    r"|Standard TM-score \(normalized by reference.*?=\s*(?P<tm2>[\d\.]+)$",
+    re.MULTILINE)
+_TMALIGN_LOG_RE = re.compile(
+    r"Aligned length=\s*(?P<len>\d+)"
+    r"|RMSD=\s*(?P<rmsd>[\d\.]+)"
+    r"|TM-score=\s*(?P<tm1>[\d\.]+) \(if normalized by length of Chain_1"
+    r"|TM-score=\s*(?P<tm2>[\d\.]+) \(if normalized by length of Chain_2")
 
 def parse_gemini_log(file_path):
     """Parses the log file from our gemini_tm_align_final.py script."""
@@ -9,21 +25,12 @@ def parse_gemini_log(file_path):
     }
     try:
         with open(file_path, 'r') as f:
-            for line in f:
-                if "Found" in line and "residue pairs" in line:
-                    match = re.search(r"Found (\d+) residue pairs", line)
-                    if match: results['len'] = match.group(1)
-                elif "Kabsch RMSD" in line:
-                    match = re.search(r"Kabsch RMSD.*?=\s*([\d\.]+)", line)
-                    if match: results['rmsd'] = match.group(1)
-                elif "Standard TM-score (normalized by mobile" in line:
-                    match = re.search(r"=\s*([\d\.]+)$", line)
-                    if match: results['tm1'] = match.group(1)
-                elif "Standard TM-score (normalized by reference" in line:
-                    match = re.search(r"=\s*([\d\.]+)$", line)
-                    if match: results['tm2'] = match.group(1)
+            content = f.read()
     except FileNotFoundError:
-        pass
+        return results
+    for match in _GEMINI_LOG_RE.finditer(content):
+        # The last occurrence of each field wins
+        results[match.lastgroup] = match.group(match.lastgroup)
     return results
 
 def parse_tmalign_log(file_path):
@@ -34,23 +41,43 @@ def parse_tmalign_log(file_path):
     try:
         with open(file_path, 'r') as f:
             content = f.read()
-            len_match = re.search(r"Aligned length=\s*(\d+)", content)
-            if len_match: results['len'] = len_match.group(1)
-
-            rmsd_match = re.search(r"RMSD=\s*([\d\.]+)", content)
-            if rmsd_match: results['rmsd'] = rmsd_match.group(1)
-
-            tm1_match = re.search(r"TM-score=\s*([\d\.]+) \(if normalized by length of Chain_1", content)
-            if tm1_match: results['tm1'] = tm1_match.group(1)
-            
-            tm2_match = re.search(r"TM-score=\s*([\d\.]+) \(if normalized by length of Chain_2", content)
-            if tm2_match: results['tm2'] = tm2_match.group(1)
-
     except FileNotFoundError:
         # This is expected if a corresponding official log doesn't exist
-        pass
+        return results
+    for match in _TMALIGN_LOG_RE.finditer(content):
+        # The first occurrence of each field wins
+        if results[match.lastgroup] == 'N/A':
+            results[match.lastgroup] = match.group(match.lastgroup)
     return results
 
+def index_log_files(log_dir, strip_suffix):
+    """Maps '<pdb1>_vs_<pdb2>' to its .log file in log_dir, dropping a trailing '_<date>' from the name if strip_suffix."""
+    log_files = {}
+    try:
+        entries = list(os.scandir(log_dir))
+    except FileNotFoundError:
+        return log_files
+    for entry in entries:
+        if not entry.name.endswith(".log"):
+            continue
+        pair_key = entry.name[:-len(".log")]
+        if strip_suffix:
+            if "_" not in pair_key:
+                continue
+            pair_key = pair_key.rsplit("_", 1)[0]
+        log_files.setdefault(pair_key, entry.path)
+    return log_files
+
+RESULT_FIELDS = ('len', 'rmsd', 'tm1', 'tm2')
+# One table row: the pair IDs, then AlignLen/RMSD/TM-score(mob)/TM-score(ref) for cutoff 3.0, 5.0, 7.0 and official TM-align
+ROW_FORMAT = "%-12s %-12s | " + " | ".join(["%10s %10s %12s %12s"] * 4)
+
+def parse_pair_logs(log_paths):
+    """Parses the cutoff 3.0/5.0/7.0 Gemini logs and the TM-align log of one pair into one flat row of field strings."""
+    cutoff_3_path, cutoff_5_path, cutoff_7_path, tmalign_path = log_paths
+    results = [parse_gemini_log(cutoff_3_path), parse_gemini_log(cutoff_5_path), parse_gemini_log(cutoff_7_path), parse_tmalign_log(tmalign_path)]
+    return [result[field] for result in results for field in RESULT_FIELDS]
+
 def main():
     gemini_log_dir_cutoff_5 = "batch_outputs"
     gemini_log_dir_cutoff_3 = "batch_outputs_cutoff_3.0"
@@ -72,68 +99,44 @@ def main():
     
     table_content = [separator, header1, header2, separator]
 
-    gemini_cutoff_5_totals = {'len': 0, 'rmsd': 0, 'tm1': 0, 'tm2': 0, 'count': 0}
-    gemini_cutoff_3_totals = {'len': 0, 'rmsd': 0, 'tm1': 0, 'tm2': 0, 'count': 0}
-    gemini_cutoff_7_totals = {'len': 0, 'rmsd': 0, 'tm1': 0, 'tm2': 0, 'count': 0}
-    tmalign_totals = {'len': 0, 'rmsd': 0, 'tm1': 0, 'tm2': 0, 'count': 0}
+    # One directory scan per log directory instead of a glob per pair
+    gemini_cutoff_5_logs = index_log_files(gemini_log_dir_cutoff_5, strip_suffix=True)
+    gemini_cutoff_3_logs = index_log_files(gemini_log_dir_cutoff_3, strip_suffix=True)
+    gemini_cutoff_7_logs = index_log_files(gemini_log_dir_cutoff_7, strip_suffix=True)
+    tmalign_logs = index_log_files(tmalign_log_dir, strip_suffix=False)
 
+    listed_pairs, pair_log_paths = [], []
     for pdb1, pdb2 in protein_pairs:
-        gemini_cutoff_5_log_pattern = os.path.join(gemini_log_dir_cutoff_5, f"{pdb1}_vs_{pdb2}_*.log")
-        gemini_cutoff_3_log_pattern = os.path.join(gemini_log_dir_cutoff_3, f"{pdb1}_vs_{pdb2}_*.log")
-        gemini_cutoff_7_log_pattern = os.path.join(gemini_log_dir_cutoff_7, f"{pdb1}_vs_{pdb2}_*.log")
-        tmalign_log_pattern = os.path.join(tmalign_log_dir, f"{pdb1}_vs_{pdb2}.log")
-        
-        gemini_cutoff_5_log_files = glob.glob(gemini_cutoff_5_log_pattern)
-        gemini_cutoff_3_log_files = glob.glob(gemini_cutoff_3_log_pattern)
-        gemini_cutoff_7_log_files = glob.glob(gemini_cutoff_7_log_pattern)
-        tmalign_log_files = glob.glob(tmalign_log_pattern)
-
-        gemini_cutoff_5_log_path = gemini_cutoff_5_log_files[0] if gemini_cutoff_5_log_files else ""
-        gemini_cutoff_3_log_path = gemini_cutoff_3_log_files[0] if gemini_cutoff_3_log_files else ""
-        gemini_cutoff_7_log_path = gemini_cutoff_7_log_files[0] if gemini_cutoff_7_log_files else ""
-        tmalign_log_path = tmalign_log_files[0] if tmalign_log_files else ""
-
-        if not all([gemini_cutoff_5_log_path, gemini_cutoff_3_log_path, gemini_cutoff_7_log_path]):
+        pair_key = f"{pdb1}_vs_{pdb2}"
+        log_paths = (gemini_cutoff_3_logs.get(pair_key, ""), gemini_cutoff_5_logs.get(pair_key, ""),
+                     gemini_cutoff_7_logs.get(pair_key, ""), tmalign_logs.get(pair_key, ""))
+        if not all(log_paths[:3]):
             continue
+        listed_pairs.append((pdb1, pdb2))
+        pair_log_paths.append(log_paths)
 
-        gemini_cutoff_5_results = parse_gemini_log(gemini_cutoff_5_log_path)
-        gemini_cutoff_3_results = parse_gemini_log(gemini_cutoff_3_log_path)
-        gemini_cutoff_7_results = parse_gemini_log(gemini_cutoff_7_log_path)
-        tmalign_results = parse_tmalign_log(tmalign_log_path)
-
-        # Accumulate totals
-        for totals, results in [(gemini_cutoff_5_totals, gemini_cutoff_5_results), 
-                                (gemini_cutoff_3_totals, gemini_cutoff_3_results), 
-                                (gemini_cutoff_7_totals, gemini_cutoff_7_results), 
-                                (tmalign_totals, tmalign_results)]:
-            if results['len'] != 'N/A':
-                totals['len'] += int(results['len'])
-                totals['rmsd'] += float(results['rmsd'])
-                totals['tm1'] += float(results['tm1'])
-                totals['tm2'] += float(results['tm2'])
-                totals['count'] += 1
-
-        row = f"{pdb1:<12} {pdb2:<12} | " \
-              f"{gemini_cutoff_3_results['len']:>10} {gemini_cutoff_3_results['rmsd']:>10} {gemini_cutoff_3_results['tm1']:>12} {gemini_cutoff_3_results['tm2']:>12} | " \
-              f"{gemini_cutoff_5_results['len']:>10} {gemini_cutoff_5_results['rmsd']:>10} {gemini_cutoff_5_results['tm1']:>12} {gemini_cutoff_5_results['tm2']:>12} | " \
-              f"{gemini_cutoff_7_results['len']:>10} {gemini_cutoff_7_results['rmsd']:>10} {gemini_cutoff_7_results['tm1']:>12} {gemini_cutoff_7_results['tm2']:>12} | " \
-              f"{tmalign_results['len']:>10} {tmalign_results['rmsd']:>10} {tmalign_results['tm1']:>12} {tmalign_results['tm2']:>12}"
-        table_content.append(row)
+    # Reading the logs is I/O-bound, so the pairs are parsed on a thread pool
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as executor:
+        pair_rows = list(executor.map(parse_pair_logs, pair_log_paths))
+
+    # (num_pairs, 2 + 4 * 4) table of strings, formatted in a single np.savetxt call
+    table = np.array([[pdb1, pdb2] + row for (pdb1, pdb2), row in zip(listed_pairs, pair_rows)], dtype=str).reshape(-1, 2 + 4 * len(RESULT_FIELDS))
+    rows_buffer = io.StringIO()
+    np.savetxt(rows_buffer, table, fmt=ROW_FORMAT)
+    table_content.extend(rows_buffer.getvalue().splitlines())
 
     table_content.append(separator)
 
-    # Calculate and add averages
-    if gemini_cutoff_5_totals['count'] > 0:
-        gemini_cutoff_5_avg = {k: v / gemini_cutoff_5_totals['count'] for k, v in gemini_cutoff_5_totals.items() if k != 'count'}
-        gemini_cutoff_3_avg = {k: v / gemini_cutoff_3_totals['count'] for k, v in gemini_cutoff_3_totals.items() if k != 'count'}
-        gemini_cutoff_7_avg = {k: v / gemini_cutoff_7_totals['count'] for k, v in gemini_cutoff_7_totals.items() if k != 'count'}
-        tmalign_avg = {k: v / tmalign_totals['count'] for k, v in tmalign_totals.items() if k != 'count'}
-        
-        avg_row = f"{'Average':<25} | " \
-                  f"{gemini_cutoff_3_avg['len']:>10.2f} {gemini_cutoff_3_avg['rmsd']:>10.2f} {gemini_cutoff_3_avg['tm1']:>12.4f} {gemini_cutoff_3_avg['tm2']:>12.4f} | " \
-                  f"{gemini_cutoff_5_avg['len']:>10.2f} {gemini_cutoff_5_avg['rmsd']:>10.2f} {gemini_cutoff_5_avg['tm1']:>12.4f} {gemini_cutoff_5_avg['tm2']:>12.4f} | " \
-                  f"{gemini_cutoff_7_avg['len']:>10.2f} {gemini_cutoff_7_avg['rmsd']:>10.2f} {gemini_cutoff_7_avg['tm1']:>12.4f} {gemini_cutoff_7_avg['tm2']:>12.4f} | " \
-                  f"{tmalign_avg['len']:>10.2f} {tmalign_avg['rmsd']:>10.2f} {tmalign_avg['tm1']:>12.4f} {tmalign_avg['tm2']:>12.4f}"
+    # Calculate and add averages; a method's average covers the pairs whose log has results
+    method_averages = []
+    for method in range(4):
+        values = table[:, 2 + 4 * method:6 + 4 * method]
+        values = values[values[:, 0] != 'N/A'].astype(np.float64)
+        method_averages.append(values.sum(axis=0) / len(values) if len(values) else None)
+
+    if method_averages[1] is not None:
+        avg_row = f"{'Average':<25} | " + " | ".join(f"{avg[0]:>10.2f} {avg[1]:>10.2f} {avg[2]:>12.4f} {avg[3]:>12.4f}"
+                                                     for avg in method_averages)
         table_content.append(avg_row)
         table_content.append(separator)
 
@@ -4,6 +4,23 @@ import argparse
 import numpy as np
 import os
 import datetime
+import contextlib
+import functools
+import hashlib
+import threading
+import io
+import itertools
+import math
+import sys
+import zipfile
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:  # Numba is optional; it only provides the fused CPU kernels behind --numba
+    njit = None
 
 # --- Constants ---
 AA_3_TO_1 = {
@@ -12,42 +29,82 @@ AA_3_TO_1 = {
     'MET': 'M', 'PHE': 'F', 'PRO': 'P', 'SER': 'S', 'THR': 'T', 'TRP': 'W', 
     'TYR': 'Y', 'VAL': 'V'
 }
+PDB_RECORD_WIDTH = 80  # Fixed-width columns read from each PDB line
+MASKED_LOG_VALUE = -1e9  # Log-probability given to padded cells in batched Sinkhorn
+SPARSE_MAX_DENSITY = 0.5  # Above this fraction of supported cells the sparse Sinkhorn falls back to the dense one
+DIST_SQ_EPS = 1e-12  # Lower clamp for squared distances before the square root
+RODRIGUES_EPS = 1e-6  # Below this squared rotation angle the Rodrigues coefficients use their Taylor series
+PLATEAU_WINDOW = 200  # Steps over which --plateau_tol measures the score change
+PLATEAU_MIN_STEPS = 500  # --plateau_tol never stops the optimization before this step
 
 # --- PDB Parsing & Writing ---
 
-def parse_pdb(file_path, chain_id=None, c_alpha_only=True):
-    """A robust PDB parser that handles alternative locations to prevent length mismatches."""
-    coords, atom_lines, sequence = [], [], []
-    seen_residues = set()
-    try:
-        with open(file_path, 'r') as f:
-            for line in f:
-                if not line.startswith("ATOM"):
-                    continue
-                if c_alpha_only and line[12:16].strip() != "CA":
-                    continue
-                if chain_id and line[21].strip() != chain_id:
-                    continue
-                
-                alt_loc = line[16]
-                if alt_loc not in (' ', 'A'):
-                    continue
-
-                if c_alpha_only:
-                    residue_uid = (line[21], line[22:27]) # (Chain ID, Residue Sequence Number + Insertion Code)
-                    if residue_uid in seen_residues:
-                        continue
-                    seen_residues.add(residue_uid)
-                coords.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
-                atom_lines.append(line)
-                sequence.append(AA_3_TO_1.get(line[17:20], 'X'))
+@functools.lru_cache(maxsize=256)
+def parse_pdb(file_path, chain_id=None, c_alpha_only=True, cache_dir=None):
+    """A robust PDB parser that handles alternative locations to prevent length mismatches.
+    Results are cached per (file_path, chain_id, c_alpha_only, cache_dir), so callers must not modify the returned tensor or list.
+    With cache_dir, parse results also persist across runs as .npz files there, reused while newer than the PDB file."""
+    cache_path = None
+    if cache_dir is not None:
+        # The directory hash keeps same-named PDB files from different directories apart
+        dir_hash = hashlib.sha1(os.path.dirname(os.path.abspath(file_path)).encode()).hexdigest()[:8]
+        cache_path = os.path.join(cache_dir, f"{os.path.basename(file_path)}.{dir_hash}.{chain_id or 'all'}.{'ca' if c_alpha_only else 'full'}.npz")
+        try:
+            if os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+                with np.load(cache_path) as cached:
+                    return torch.from_numpy(cached['coords']), cached['atom_lines'].tolist(), str(cached['sequence'])
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass  # Missing, stale or unreadable cache entry: parse the PDB file
+
+    coords, atom_lines, sequence = read_pdb(file_path, chain_id, c_alpha_only)
+    if cache_path is not None and coords is not None:
+        # Written under a unique name and renamed, so concurrent workers never see a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, coords=coords.numpy(), atom_lines=np.array(atom_lines), sequence=np.array(sequence))
+            os.replace(tmp_path, cache_path)
+        except OSError:  # Unwritable or full cache directory: the cache is best-effort, so keep the parse result
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return coords, atom_lines, sequence
 
+def read_pdb(file_path, chain_id=None, c_alpha_only=True):
+    """Parses a PDB file into (C-alpha or all-atom coords, ATOM lines, sequence); use parse_pdb for the cached version.
+    Records are filtered as a fixed-width (N, 80) byte array with numpy instead of line by line."""
+    try:
+        with open(file_path, 'rb') as f:
+            raw_lines = f.read().splitlines()
     except FileNotFoundError:
         print(f"Error: PDB file not found at {file_path}")
         return None, None, None
-    if not coords:
+
+    records = np.array(raw_lines, dtype=f'S{PDB_RECORD_WIDTH}').reshape(-1)
+    columns = records.view(np.uint8).reshape(len(records), PDB_RECORD_WIDTH)
+    keep = np.all(columns[:, 0:4] == np.frombuffer(b'ATOM', dtype=np.uint8), axis=1)
+    if c_alpha_only:
+        keep &= np.char.strip(columns[:, 12:16].copy().view('S4').ravel()) == b'CA'
+    if chain_id:
+        keep &= np.char.strip(columns[:, 21:22].copy().view('S1').ravel()) == chain_id.encode()
+    keep &= (columns[:, 16] == ord(' ')) | (columns[:, 16] == ord('A'))
+    indices = np.flatnonzero(keep)
+
+    if c_alpha_only and len(indices):
+        # First occurrence of each (Chain ID, Residue Sequence Number + Insertion Code)
+        residue_uid = columns[indices, 21:27].copy().view('S6').ravel()
+        _, first = np.unique(residue_uid, return_index=True)
+        indices = indices[np.sort(first)]
+    if not len(indices):
         print(f"Error: No matching C-alpha atoms found in {file_path} for specified chain.")
         return None, None, None
+
+    fields = columns[indices]
+    coords = np.stack([fields[:, start:start + 8].copy().view('S8').ravel().astype(np.float64) for start in (30, 38, 46)], axis=1)
+    atom_lines = [raw_lines[i].decode() + "\n" for i in indices]
+    sequence = [AA_3_TO_1.get(name, 'X') for name in fields[:, 17:20].copy().view('S3').ravel().astype(str)]
     return torch.tensor(coords, dtype=torch.float32), atom_lines, "".join(sequence)
 
 def write_pdb(file_path, coords, atom_lines):
@@ -56,13 +113,39 @@ def write_pdb(file_path, coords, atom_lines):
             x, y, z = coords[i]
             f.write(f"{line[:30]}{x:8.3f}{y:8.3f}{z:8.3f}{line[54:].rstrip()}\n")
 
+def parse_pdb_batch(file_paths, chain_ids=None, c_alpha_only=True, cache_dir=None):
+    """Parses several PDB files into one zero-padded (B, L_max, 3) tensor with a (B, L_max) bool mask of valid residues."""
+    chain_ids = chain_ids or [None] * len(file_paths)
+    parsed = [parse_pdb(path, chain, c_alpha_only=c_alpha_only, cache_dir=cache_dir) for path, chain in zip(file_paths, chain_ids)]
+    if any(coords is None for coords, _, _ in parsed):
+        return None, None, None, None
+    lengths = torch.tensor([len(coords) for coords, _, _ in parsed])
+    coords = torch.nn.utils.rnn.pad_sequence([coords for coords, _, _ in parsed], batch_first=True)
+    mask = torch.arange(coords.shape[1])[None, :] < lengths[:, None]
+    return coords, mask, [lines for _, lines, _ in parsed], [seq for _, _, seq in parsed]
+
 # --- Core Alignment & Optimization Logic ---
 
-def get_transformation_matrix(params_vector):
-    w, u = params_vector[:3], params_vector[3:]
-    W = torch.zeros((3, 3), dtype=params_vector.dtype, device=params_vector.device)
-    W[0, 1], W[0, 2] = -w[2], w[1]; W[1, 0], W[1, 2] = w[2], -w[0]; W[2, 0], W[2, 1] = -w[1], w[0]
-    return torch.linalg.matrix_exp(W), u
+def get_transformation_matrix(params_vector, eps=RODRIGUES_EPS):
+    # type: (Tensor, float) -> Tuple[Tensor, Tensor]
+    """Maps (..., 6) Lie algebra parameters to (..., 3, 3) rotations and (..., 3) translations."""
+    w, u = params_vector[..., :3], params_vector[..., 3:]
+    zero = torch.zeros_like(w[..., 0])
+    W = torch.stack([
+        torch.stack([zero, -w[..., 2], w[..., 1]], dim=-1),
+        torch.stack([w[..., 2], zero, -w[..., 0]], dim=-1),
+        torch.stack([-w[..., 1], w[..., 0], zero], dim=-1),
+    ], dim=-2)
+    # Rodrigues' formula: exp(W) = I + sin(t)/t * W + (1 - cos(t))/t^2 * W^2 with t = |w|.
+    # 1 - cos(t) is written as 2 sin^2(t/2) to avoid cancellation in fp32, and the Taylor
+    # branch near t = 0 keeps the gradient finite at the zero initialization.
+    theta_sq = (w * w).sum(dim=-1)[..., None, None]
+    small = theta_sq < eps
+    theta = torch.sqrt(torch.where(small, torch.ones_like(theta_sq), theta_sq))
+    A = torch.where(small, 1.0 - theta_sq / 6.0, torch.sin(theta) / theta)
+    B = torch.where(small, 0.5 - theta_sq / 24.0, 2.0 * torch.sin(0.5 * theta)**2 / (theta * theta))
+    I = torch.eye(3, dtype=params_vector.dtype, device=params_vector.device)
+    return I + A * W + B * (W @ W), u
 
 def get_d0(length):
     return 1.24 * (length - 15)**(1/3) - 1.8 if length > 15 else 0.5
@@ -80,90 +163,260 @@ def kabsch(A, B):
     t = centroid_B - R @ centroid_A
     return R, t
 
-def sinkhorn_iterations(M, num_iters=10):
-    P = M
+def sinkhorn_iterations(reward_matrix, gamma=20.0, num_iters=10, mask=None, masked_value=MASKED_LOG_VALUE):
+    # type: (Tensor, float, int, Optional[Tensor], float) -> Tensor
+    """Log-domain Sinkhorn normalization of exp(gamma * reward_matrix); avoids overflow for large gamma.
+    Works on (len_a, len_b) or batched (B, len_a, len_b) inputs; cells outside `mask` (padding) get no mass."""
+    log_P = gamma * reward_matrix
+    if mask is not None: log_P = log_P.masked_fill(~mask, masked_value)
     for _ in range(num_iters):
-        P = P / (P.sum(dim=1, keepdim=True) + 1e-8)
-        P = P / (P.sum(dim=0, keepdim=True) + 1e-8)
-    return P
-
-def get_sinkhorn_alignment_score(coords_a, coords_b, len_a, len_b, cutoff=7.0, steepness=2.0, gamma=20.0, sinkhorn_iters=10):
-    d0 = get_d0(len_b)
-    dist_matrix = torch.cdist(coords_a, coords_b)
-    s_ij = 1.0 / (1.0 + (dist_matrix / d0)**2)
+        log_P = log_P - torch.logsumexp(log_P, dim=-1, keepdim=True)
+        if mask is not None: log_P = log_P.masked_fill(~mask, masked_value)
+        log_P = log_P - torch.logsumexp(log_P, dim=-2, keepdim=True)
+        if mask is not None: log_P = log_P.masked_fill(~mask, masked_value)
+    return torch.exp(log_P)
+
+def get_distance_matrix(coords_a, coords_b, coords_b_sq=None):
+    """Pairwise distances and squared distances. On CUDA the squares are expanded as |a|^2 + |b|^2 - 2 a.b, i.e. one
+    cuBLAS GEMM plus broadcasts (with a GEMM backward instead of the cdist backward kernel); pass coords_b_sq = |b|^2
+    when coords_b is constant across calls. On CPU torch.cdist, which already uses a GEMM internally, measured faster and is kept."""
+    if coords_a.device.type != 'cuda':
+        dist_matrix = torch.cdist(coords_a, coords_b)
+        return dist_matrix, dist_matrix * dist_matrix
+    # Needs fp32 inputs: in reduced precision the expansion would cancel catastrophically
+    if coords_b_sq is None: coords_b_sq = (coords_b**2).sum(dim=-1)
+    coords_a_sq = (coords_a**2).sum(dim=-1, keepdim=True)
+    dist_sq = coords_a_sq + coords_b_sq.unsqueeze(-2) - 2.0 * torch.matmul(coords_a, coords_b.transpose(-1, -2))
+    # The clamp also zeroes the gradient at coincident points, where sqrt would give inf * 0
+    dist_sq = dist_sq.clamp_min(DIST_SQ_EPS)
+    return dist_sq.sqrt(), dist_sq
+
+def get_reward_matrix(coords_a, coords_b, inv_d0_sq, cutoff, steepness, coords_b_sq=None):
+    """TM-score-like similarity s_ij damped by a sigmoid distance cutoff w_ij; a purely elementwise chain that
+    torch.compile can fuse into one kernel (see --compile). s_ij only needs the squared distances and 1/d0^2."""
+    dist_matrix, dist_sq = get_distance_matrix(coords_a, coords_b, coords_b_sq)
+    s_ij = 1.0 / (1.0 + dist_sq * inv_d0_sq)
     w_ij = torch.sigmoid(-(dist_matrix - cutoff) * steepness)
-    reward_matrix = s_ij * w_ij
-    P = sinkhorn_iterations(torch.exp(gamma * reward_matrix), num_iters=sinkhorn_iters)
-    score = torch.sum(P * reward_matrix) / len_b
+    return s_ij * w_ij
+
+def get_sinkhorn_alignment_score(coords_a, coords_b, len_b, inv_d0_sq, cutoff=7.0, steepness=2.0, gamma=20.0, sinkhorn_iters=10,
+                                 mask=None, reward_fn=get_reward_matrix, sinkhorn_fn=sinkhorn_iterations, coords_b_sq=None):
+    """Dense Sinkhorn score (normalized by len_b) and alignment matrix P; inv_d0_sq = 1 / d0(len_b)^2 is loop-invariant,
+    so callers compute it once (a float, or a (B, 1, 1) tensor for batched inputs)."""
+    reward_matrix = reward_fn(coords_a, coords_b, inv_d0_sq, cutoff, steepness, coords_b_sq)
+    if mask is not None: reward_matrix = reward_matrix * mask
+    P = sinkhorn_fn(reward_matrix, gamma, sinkhorn_iters, mask)
+    score = torch.sum(P * reward_matrix, dim=(-2, -1)) / len_b
     return score, P
 
-def decode_alignment_matrix(P):
-    aligned_pairs = []
-    used_cols = set()
-    row_indices = torch.arange(P.shape[0])
-    best_cols = torch.argmax(P, dim=1)
-    confidences = P[row_indices, best_cols]
-    sorted_indices = torch.argsort(confidences, descending=True)
-    for i in sorted_indices:
-        j = best_cols[i]
-        if j.item() not in used_cols:
-            aligned_pairs.append((i.item(), j.item()))
-            used_cols.add(j.item())
-    return sorted(aligned_pairs)
+# --- Fused CPU Kernels (Numba) ---
 
-# --- Main Execution ---
-def main():
-    start_time = datetime.datetime.now()
-    parser = argparse.ArgumentParser(description="A custom tool for protein structure alignment.", formatter_class=argparse.RawTextHelpFormatter,
-        epilog="""    Author: Yue Hu (huyue@qlu.edu.cn)\n    Affiliation: Qilu University of Technology (Shandong Academy of Sciences)\n\n    Example Usage:\n      # Find the optimal superposition and save the matrix and superposed structure
-      python3 gemini_tm_align_final.py --mobile mobile.pdb --reference ref.pdb --matrix_out matrix.txt --output aligned.pdb""")
-    parser.add_argument("--mobile", required=True, help="Path to the mobile PDB file.")
-    parser.add_argument("--reference", required=True, help="Path to the reference PDB file.")
-    parser.add_argument("--output", default=None, help="Path to save the aligned mobile PDB.")
-    parser.add_argument("--matrix_out", default=None, help="File to save the final transformation matrix.")
-    parser.add_argument("--mobile_chain", default=None, help="Chain ID for the mobile protein.")
-    parser.add_argument("--reference_chain", default=None, help="Chain ID for the reference protein.")
-    parser.add_argument("--steps", type=int, default=5000, help="Number of optimization steps.")
-    parser.add_argument("--lr", type=float, default=1e-3, help="Learning rate.")
-    parser.add_argument("--print_freq", type=int, default=100, help="Frequency of printing progress.")
-    parser.add_argument("--cutoff", type=float, default=7.0, help="Distance cutoff for sigmoid weight.")
-    parser.add_argument("--steepness", type=float, default=2.0, help="Steepness of the sigmoid cutoff.")
-    parser.add_argument("--gamma", type=float, default=20.0, help="Sharpness factor for Sinkhorn.")
-    parser.add_argument("--sinkhorn_iters", type=int, default=10, help="Number of Sinkhorn iterations.")
-    args = parser.parse_args()
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _numba_sinkhorn_forward(coords_a, coords_b, len_a, len_b, inv_d0_sq, cutoff, steepness, gamma, num_iters):
+        """Reward matrix, Sinkhorn scaling and score of each padded pair in one parallel loop nest.
+        Works in float64 in the scaling domain (K = exp(gamma * reward) <= exp(gamma) cannot overflow for gamma < 700),
+        so each iteration is a pair of matrix-vector sums; the per-iteration scalings u, v are kept for the backward pass."""
+        batch, max_a, max_b = coords_a.shape[0], coords_a.shape[1], coords_b.shape[1]
+        reward = np.zeros((batch, max_a, max_b))
+        kernel = np.zeros((batch, max_a, max_b))
+        P = np.zeros((batch, max_a, max_b))
+        u_hist = np.zeros((batch, num_iters, max_a))
+        v_hist = np.ones((batch, num_iters + 1, max_b))  # v_hist[:, 0] is the initialization
+        score = np.zeros(batch)
+        for b in range(batch):
+            la, lb = len_a[b], len_b[b]
+            for i in prange(la):
+                for j in range(lb):
+                    dx = coords_a[b, i, 0] - coords_b[b, j, 0]
+                    dy = coords_a[b, i, 1] - coords_b[b, j, 1]
+                    dz = coords_a[b, i, 2] - coords_b[b, j, 2]
+                    dist_sq = dx * dx + dy * dy + dz * dz
+                    reward[b, i, j] = 1.0 / (1.0 + dist_sq * inv_d0_sq[b]) / (1.0 + np.exp((np.sqrt(dist_sq) - cutoff) * steepness))
+                    kernel[b, i, j] = np.exp(gamma * reward[b, i, j])
+            for t in range(num_iters):
+                for i in prange(la):
+                    acc = 0.0
+                    for j in range(lb):
+                        acc += kernel[b, i, j] * v_hist[b, t, j]
+                    u_hist[b, t, i] = 1.0 / acc
+                for j in prange(lb):
+                    acc = 0.0
+                    for i in range(la):
+                        acc += kernel[b, i, j] * u_hist[b, t, i]
+                    v_hist[b, t + 1, j] = 1.0 / acc
+            total = 0.0
+            for i in prange(la):
+                row = 0.0
+                for j in range(lb):
+                    P[b, i, j] = kernel[b, i, j] * u_hist[b, num_iters - 1, i] * v_hist[b, num_iters, j]
+                    row += P[b, i, j] * reward[b, i, j]
+                total += row
+            score[b] = total / lb
+        return score, P, reward, kernel, u_hist, v_hist
 
-    print(f"\n**************************************************************************\n *              gemini_tm_align_final.py (2025)                       *\n * A tool to find the optimal superposition for protein structures      *\n * Developed with Gemini based on the principles of TM-align            *\n * Author: Yue Hu (huyue@qlu.edu.cn)                                  *\n **************************************************************************\n\nProgram started at: {start_time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _numba_sinkhorn_backward(grad_score, coords_a, coords_b, len_a, len_b, inv_d0_sq, cutoff, steepness, gamma, num_iters, reward, kernel, P, u_hist, v_hist):
+        """Gradient of the scores w.r.t. coords_a, back-propagated by hand through the unrolled Sinkhorn iterations
+        (written for the log-potentials f = log u, g = log v, so every step is a softmax-style correction)."""
+        batch, max_a = coords_a.shape[0], coords_a.shape[1]
+        grad_a = np.zeros((batch, max_a, 3))
+        for b in range(batch):
+            la, lb = len_a[b], len_b[b]
+            scale = grad_score[b] / lb
+            # dL/dK for K = gamma * reward, seeded by the score's dependence on P = exp(K + f + g)
+            K_bar = np.empty((la, lb))
+            tmp = np.empty((la, lb))
+            f_bar = np.zeros(la)
+            g_bar = np.zeros(lb)
+            for i in prange(la):
+                acc = 0.0
+                for j in range(lb):
+                    K_bar[i, j] = scale * reward[b, i, j] * P[b, i, j]
+                    acc += K_bar[i, j]
+                f_bar[i] = acc
+            for j in prange(lb):
+                acc = 0.0
+                for i in range(la):
+                    acc += K_bar[i, j]
+                g_bar[j] = acc
+            for t in range(num_iters - 1, -1, -1):
+                # g^{t+1} = -LSE_i(K + f^{t+1})
+                for i in prange(la):
+                    acc = 0.0
+                    for j in range(lb):
+                        tmp[i, j] = g_bar[j] * kernel[b, i, j] * u_hist[b, t, i] * v_hist[b, t + 1, j]
+                        K_bar[i, j] -= tmp[i, j]
+                        acc += tmp[i, j]
+                    f_bar[i] -= acc
+                # f^{t+1} = -LSE_j(K + g^t)
+                for i in prange(la):
+                    for j in range(lb):
+                        tmp[i, j] = f_bar[i] * kernel[b, i, j] * u_hist[b, t, i] * v_hist[b, t, j]
+                        K_bar[i, j] -= tmp[i, j]
+                for j in prange(lb):
+                    acc = 0.0
+                    for i in range(la):
+                        acc += tmp[i, j]
+                    g_bar[j] = -acc
+                f_bar[:] = 0.0
+            # Chain rule through reward = s(d) * w(d) and d = |a_i - b_j|
+            for i in prange(la):
+                for j in range(lb):
+                    dx = coords_a[b, i, 0] - coords_b[b, j, 0]
+                    dy = coords_a[b, i, 1] - coords_b[b, j, 1]
+                    dz = coords_a[b, i, 2] - coords_b[b, j, 2]
+                    dist_sq = dx * dx + dy * dy + dz * dz
+                    if dist_sq < DIST_SQ_EPS:
+                        continue
+                    dist = np.sqrt(dist_sq)
+                    s_ij = 1.0 / (1.0 + dist_sq * inv_d0_sq[b])
+                    w_ij = 1.0 / (1.0 + np.exp((dist - cutoff) * steepness))
+                    reward_bar = scale * P[b, i, j] + gamma * K_bar[i, j]
+                    coef = reward_bar * (-2.0 * inv_d0_sq[b] * s_ij * s_ij * w_ij - steepness * s_ij * w_ij * (1.0 - w_ij) / dist)
+                    grad_a[b, i, 0] += coef * dx
+                    grad_a[b, i, 1] += coef * dy
+                    grad_a[b, i, 2] += coef * dz
+        return grad_a
 
-    c_alpha_only = True
-    mobile_coords, mobile_lines, mobile_seq = parse_pdb(args.mobile, args.mobile_chain, c_alpha_only=c_alpha_only)
-    ref_coords, _, ref_seq = parse_pdb(args.reference, args.reference_chain, c_alpha_only=c_alpha_only)
-    if mobile_coords is None or ref_coords is None: return
+class NumbaSinkhornScore(torch.autograd.Function):
+    """Sinkhorn score and alignment matrix of padded (B, L, 3) CPU coordinates from the fused Numba kernels.
+    Only coords_a (the moving structure) receives a gradient; P is returned without one."""
 
-    len_mobile, len_ref = len(mobile_seq), len(ref_seq)
-    print(f"Name of Chain_1: {os.path.basename(args.mobile)} (chain {args.mobile_chain or 'All'})\nName of Chain_2: {os.path.basename(args.reference)} (chain {args.reference_chain or 'All'})\nLength of Chain_1: {len_mobile} residues\nLength of Chain_2: {len_ref} residues\n")
+    @staticmethod
+    def forward(ctx, coords_a, coords_b, len_a, len_b, inv_d0_sq, cutoff, steepness, gamma, num_iters):
+        arrays = (coords_a.detach().double().numpy(), coords_b.detach().double().numpy(),
+                  len_a.numpy().astype(np.int64), len_b.numpy().astype(np.int64), inv_d0_sq.reshape(-1).double().numpy())
+        score, P, reward, kernel, u_hist, v_hist = _numba_sinkhorn_forward(*arrays, cutoff, steepness, gamma, num_iters)
+        ctx.kernel_args = arrays + (cutoff, steepness, gamma, num_iters, reward, kernel, P, u_hist, v_hist)
+        P = torch.from_numpy(P).to(coords_a.dtype)
+        ctx.mark_non_differentiable(P)
+        return torch.from_numpy(score).to(coords_a.dtype), P
 
-    mobile_center, ref_center = mobile_coords.mean(dim=0), ref_coords.mean(dim=0)
-    mobile_coords_opt, ref_coords_opt = mobile_coords - mobile_center, ref_coords - ref_center
+    @staticmethod
+    def backward(ctx, grad_score, grad_P):
+        grad_a = _numba_sinkhorn_backward(grad_score.double().numpy(), *ctx.kernel_args)
+        return torch.from_numpy(grad_a).to(grad_score.dtype), None, None, None, None, None, None, None, None
 
-    transform_params = torch.randn(1, 6, requires_grad=True); torch.nn.init.zeros_(transform_params)
-    optimizer = optim.AdamW([transform_params], lr=args.lr)
+def get_numba_sinkhorn_alignment_score(coords_a, coords_b, len_a, len_b, inv_d0_sq, cutoff=7.0, steepness=2.0, gamma=20.0, sinkhorn_iters=10):
+    """Same result as get_sinkhorn_alignment_score from the fused Numba kernels (CPU only, needs numba); padding is
+    given by the (B,) valid lengths len_a and len_b instead of a mask."""
+    if not torch.is_tensor(inv_d0_sq): inv_d0_sq = torch.full((coords_a.shape[0],), float(inv_d0_sq))
+    return NumbaSinkhornScore.apply(coords_a, coords_b, torch.as_tensor(len_a), torch.as_tensor(len_b), inv_d0_sq, cutoff, steepness, gamma, sinkhorn_iters)
 
-    print("--- Finding Optimal Superposition (Sinkhorn Differentiable TM-score) ---")
-    final_P = None
-    for step in range(args.steps):
-        optimizer.zero_grad()
-        R, u = get_transformation_matrix(transform_params.squeeze(0))
-        transformed_mobile = torch.matmul(mobile_coords_opt, R.T) + u
-        score, P = get_sinkhorn_alignment_score(transformed_mobile, ref_coords_opt, len_mobile, len_ref, cutoff=args.cutoff, steepness=args.steepness, gamma=args.gamma, sinkhorn_iters=args.sinkhorn_iters)
-        loss = -score
-        if step % args.print_freq == 0 or step == args.steps - 1:
-            print(f"Step {step:05d}: Sinkhorn Score = {score.item():.4f}")
-        loss.backward();
-        optimizer.step()
-    final_P = P.detach()
-    print("--- Global Search Finished ---\n")
+def get_sinkhorn_support(coords_a, coords_b, radius, mask=None, max_density=SPARSE_MAX_DENSITY):
+    """Returns (batch, row, col) indices of the (B, len_a, len_b) cells closer than radius, or None if too dense to pay off."""
+    with torch.no_grad():
+        support = torch.cdist(coords_a, coords_b) < radius
+        if mask is None:
+            density = support.float().mean()
+        else:  # Density among the valid cells only, so padding does not dilute it
+            support &= mask
+            density = support.sum() / mask.sum().clamp_min(1)
+        if density > max_density:
+            return None
+        return support.nonzero(as_tuple=True)
+
+def get_sparse_sinkhorn_alignment_score(coords_a, coords_b, len_b, support, inv_d0_sq, cutoff=7.0, steepness=2.0, gamma=20.0, sinkhorn_iters=10,
+                                        mask_a=None, mask_b=None):
+    """Sinkhorn score of batched (B, L, 3) coordinates with the reward evaluated only on the `support` cells.
+    The reward is taken as 0 elsewhere, where the kernel exp(gamma * reward) is exactly 1, so row and column sums are
+    a dense total plus a sparse correction: the same log-domain iterations as sinkhorn_iterations at O(nnz + L) cost."""
+    b_idx, i_idx, j_idx = support
+    batch, len_rows, len_cols = coords_a.shape[0], coords_a.shape[1], coords_b.shape[1]
+    inv_d0_sq_cells = inv_d0_sq.reshape(-1)[b_idx] if torch.is_tensor(inv_d0_sq) else inv_d0_sq
+    dist_sq = ((coords_a[b_idx, i_idx] - coords_b[b_idx, j_idx])**2).sum(dim=-1).clamp_min(DIST_SQ_EPS)
+    dist = dist_sq.sqrt()
+    s_ij = 1.0 / (1.0 + dist_sq * inv_d0_sq_cells)
+    w_ij = torch.sigmoid(-(dist - cutoff) * steepness)
+    reward = s_ij * w_ij
+    kernel_excess = torch.expm1(gamma * reward)  # exp(gamma * reward) - 1 on the support, 0 elsewhere
+
+    rows_valid = mask_a if mask_a is not None else torch.ones(batch, len_rows, dtype=torch.bool, device=coords_a.device)
+    cols_valid = mask_b if mask_b is not None else torch.ones(batch, len_cols, dtype=torch.bool, device=coords_b.device)
+    log_f = torch.zeros(batch, len_rows, dtype=reward.dtype, device=coords_a.device).masked_fill(~rows_valid, float('-inf'))
+    log_g = torch.zeros(batch, len_cols, dtype=reward.dtype, device=coords_b.device).masked_fill(~cols_valid, float('-inf'))
+    for _ in range(sinkhorn_iters):
+        g_shift = log_g.amax(dim=1, keepdim=True)
+        exp_g = torch.exp(log_g - g_shift)
+        row_sums = exp_g.sum(dim=1, keepdim=True).expand(batch, len_rows)
+        row_sums = row_sums.index_put((b_idx, i_idx), kernel_excess * exp_g[b_idx, j_idx], accumulate=True)
+        log_f = torch.where(rows_valid, -(g_shift + torch.log(row_sums)), log_f)
+
+        f_shift = log_f.amax(dim=1, keepdim=True)
+        exp_f = torch.exp(log_f - f_shift)
+        col_sums = exp_f.sum(dim=1, keepdim=True).expand(batch, len_cols)
+        col_sums = col_sums.index_put((b_idx, j_idx), kernel_excess * exp_f[b_idx, i_idx], accumulate=True)
+        log_g = torch.where(cols_valid, -(f_shift + torch.log(col_sums)), log_g)
+
+    P_support = torch.exp(gamma * reward + log_f[b_idx, i_idx] + log_g[b_idx, j_idx])
+    score = torch.zeros(batch, dtype=reward.dtype, device=reward.device).index_add(0, b_idx, P_support * reward) / len_b
+    return score
+
+def decode_alignment_matrix(P):
+    """Greedy hard assignment: each row takes its argmax column and each column keeps its most confident row."""
+    num_cols = P.shape[1]
+    best_cols = torch.argmax(P, dim=1)
+    confidences = P.gather(1, best_cols[:, None]).squeeze(1)
+    col_best_conf = torch.full((num_cols,), float('-inf'), dtype=P.dtype, device=P.device)
+    col_best_conf = col_best_conf.scatter_reduce(0, best_cols, confidences, reduce='amax')
+    rows = torch.nonzero(confidences == col_best_conf[best_cols]).squeeze(1)
+    # Exact confidence ties keep the lowest row index so every column is used at most once
+    cols = best_cols[rows]
+    col_first_row = torch.full((num_cols,), P.shape[0], dtype=rows.dtype, device=P.device)
+    col_first_row = col_first_row.scatter_reduce(0, cols, rows, reduce='amin')
+    rows = rows[rows == col_first_row[cols]]
+    return list(zip(rows.tolist(), best_cols[rows].tolist()))
+
+# --- Main Execution ---
 
-    R_final, u_final = get_transformation_matrix(transform_params.detach().clone().squeeze(0))
+def print_pair_header(mobile_path, ref_path, mobile_chain, ref_chain, len_mobile, len_ref):
+    print(f"Name of Chain_1: {os.path.basename(mobile_path)} (chain {mobile_chain or 'All'})\nName of Chain_2: {os.path.basename(ref_path)} (chain {ref_chain or 'All'})\nLength of Chain_1: {len_mobile} residues\nLength of Chain_2: {len_ref} residues\n")
+
+def report_alignment(mobile_path, ref_path, mobile_chain, mobile_coords_opt, ref_coords_opt, ref_center, mobile_seq, ref_seq,
+                     R_final, u_final, final_P, output=None, matrix_out=None, parse_cache_dir=None):
+    """Prints the alignment analysis for one optimized pair and writes the requested output files."""
+    len_mobile, len_ref = len(mobile_seq), len(ref_seq)
     final_aligned_coords = torch.matmul(mobile_coords_opt, R_final.T) + u_final
 
     aligned_pairs = decode_alignment_matrix(final_P)
@@ -199,31 +452,283 @@ def main():
     for i in range(0, len(aligned_pairs), 6):
         print(" ".join(map(str, aligned_pairs[i:i+6])))
 
-    if args.output:
+    if output:
         print(f"\n--- Generating Final Aligned Structure ---")
-        mobile_coords_full, mobile_lines_full, _ = parse_pdb(args.mobile, args.mobile_chain, c_alpha_only=False)
+        mobile_coords_full, mobile_lines_full, _ = parse_pdb(mobile_path, mobile_chain, c_alpha_only=False, cache_dir=parse_cache_dir)
         mobile_center_full = mobile_coords_full.mean(dim=0)
         centered_mobile_full = mobile_coords_full - mobile_center_full
         final_full_coords_out = (torch.matmul(centered_mobile_full, R_final.T) + u_final) + ref_center
-        print(f"Writing aligned mobile protein to '{args.output}'...")
-        write_pdb(args.output, final_full_coords_out, mobile_lines_full)
-        print(f"Success! You can now load '{args.reference}' and '{args.output}' into a viewer.")
-        print(f"To verify, you can run: ./TMalign/TMalign {args.reference} {args.output}")
+        print(f"Writing aligned mobile protein to '{output}'...")
+        write_pdb(output, final_full_coords_out, mobile_lines_full)
+        print(f"Success! You can now load '{ref_path}' and '{output}' into a viewer.")
+        print(f"To verify, you can run: ./TMalign/TMalign {ref_path} {output}")
 
-    if args.matrix_out:
+    if matrix_out:
         print(f"\n--- Saving Transformation Matrix ---")
-        with open(args.matrix_out, 'w') as f:
-            f.write(f"# Transformation matrix for {os.path.basename(args.mobile)} -> {os.path.basename(args.reference)}\n")
+        with open(matrix_out, 'w') as f:
+            f.write(f"# Transformation matrix for {os.path.basename(mobile_path)} -> {os.path.basename(ref_path)}\n")
             f.write(f"# This matrix should be applied to the CENTERED coordinates of the mobile protein.\n")
             f.write(f"t[0] = {u_final[0]:.8f}, t[1] = {u_final[1]:.8f}, t[2] = {u_final[2]:.8f}\n")
             f.write(f"u[0][0] = {R_final[0,0]:.8f}, u[0][1] = {R_final[0,1]:.8f}, u[0][2] = {R_final[0,2]:.8f}\n")
             f.write(f"u[1][0] = {R_final[1,0]:.8f}, u[1][1] = {R_final[1,1]:.8f}, u[1][2] = {R_final[1,2]:.8f}\n")
             f.write(f"u[2][0] = {R_final[2,0]:.8f}, u[2][1] = {R_final[2,1]:.8f}, u[2][2] = {R_final[2,2]:.8f}\n")
-        print(f"Transformation matrix saved to '{args.matrix_out}'")
+        print(f"Transformation matrix saved to '{matrix_out}'")
+
+def print_banner(start_time):
+    print(f"\n**************************************************************************\n *              gemini_tm_align_final.py (2025)                       *\n * A tool to find the optimal superposition for protein structures      *\n * Developed with Gemini based on the principles of TM-align            *\n * Author: Yue Hu (huyue@qlu.edu.cn)                                  *\n **************************************************************************\n\nProgram started at: {start_time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+def pair_output_paths(args, pdb1, pdb2):
+    """(aligned PDB, matrix, log) paths of one --pair_file pair in --output_dir, named like run_batch_align*.sh output
+    (<pdb1>_aligned_to_<pdb2>_<suffix>.pdb, <pdb1>_vs_<pdb2>_<suffix>.log) so compare_results.py finds the logs."""
+    suffix = f"_{args.output_suffix}" if args.output_suffix else ""
+    return (os.path.join(args.output_dir, f"{pdb1}_aligned_to_{pdb2}{suffix}.pdb"),
+            os.path.join(args.output_dir, f"{pdb1}_vs_{pdb2}{suffix}_matrix.txt"),
+            os.path.join(args.output_dir, f"{pdb1}_vs_{pdb2}{suffix}.log"))
+
+def align_pairs(args, mobile_paths, ref_paths, pairs=None):
+    """Optimizes all (mobile, reference) pairs jointly as one zero-padded batch and reports each of them.
+    `pairs` holds the (mobile ID, reference ID) names in --pair_file mode; without it the single pair is reported as a --mobile/--reference run.
+    Returns the number of pairs that were aligned (pairs that cannot be parsed are skipped)."""
+    start_time = datetime.datetime.now()
+    c_alpha_only = True
+    # A pair whose mobile or reference structure cannot be parsed is skipped; the other pairs are still aligned
+    parsed_ok = [parse_pdb(mobile_path, args.mobile_chain, c_alpha_only=c_alpha_only, cache_dir=args.parse_cache_dir)[0] is not None
+                 and parse_pdb(ref_path, args.reference_chain, c_alpha_only=c_alpha_only, cache_dir=args.parse_cache_dir)[0] is not None
+                 for mobile_path, ref_path in zip(mobile_paths, ref_paths)]
+    if pairs is not None:
+        for (pdb1, pdb2), ok in zip(pairs, parsed_ok):
+            if not ok: print(f"Warning: could not parse {pdb1} or {pdb2}. Skipping this pair.")
+        pairs = [pair for pair, ok in zip(pairs, parsed_ok) if ok]
+    mobile_paths = [path for path, ok in zip(mobile_paths, parsed_ok) if ok]
+    ref_paths = [path for path, ok in zip(ref_paths, parsed_ok) if ok]
+    num_pairs = len(mobile_paths)
+    if num_pairs == 0: return 0
+    mobile_coords, mobile_mask, _, mobile_seqs = parse_pdb_batch(mobile_paths, [args.mobile_chain] * num_pairs, c_alpha_only=c_alpha_only, cache_dir=args.parse_cache_dir)
+    ref_coords, ref_mask, _, ref_seqs = parse_pdb_batch(ref_paths, [args.reference_chain] * num_pairs, c_alpha_only=c_alpha_only, cache_dir=args.parse_cache_dir)
+    if mobile_coords is None or ref_coords is None: return 0
+
+    lens_mobile, lens_ref = mobile_mask.sum(dim=1), ref_mask.sum(dim=1)
+    if pairs is None:
+        print_pair_header(mobile_paths[0], ref_paths[0], args.mobile_chain, args.reference_chain, len(mobile_seqs[0]), len(ref_seqs[0]))
+    else:
+        print(f"Aligning {num_pairs} pairs from {args.pair_file} as one batch (padded to {mobile_coords.shape[1]} x {ref_coords.shape[1]} residues)\n")
+
+    mobile_center = mobile_coords.sum(dim=1) / lens_mobile[:, None]
+    ref_center = ref_coords.sum(dim=1) / lens_ref[:, None]
+    mobile_coords_opt = (mobile_coords - mobile_center[:, None, :]) * mobile_mask[..., None]
+    ref_coords_opt = (ref_coords - ref_center[:, None, :]) * ref_mask[..., None]
+    pair_mask = mobile_mask[:, :, None] & ref_mask[:, None, :]
+    if pair_mask.all(): pair_mask = None
+
+    # The optimization runs on the GPU when available, in fp32 like on CPU: the log-domain Sinkhorn iterations
+    # (exp, logsumexp) and the distance expansion are not safe in bf16/fp16.
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    mobile_coords_opt, ref_coords_opt = mobile_coords_opt.to(device), ref_coords_opt.to(device)
+    if pair_mask is not None: pair_mask = pair_mask.to(device)
+    # Loop invariants of the score: 1/d0^2 of each reference (cutoff and steepness stay Python scalars, which kernels take by value)
+    inv_d0_sq_ref = torch.tensor([1.0 / get_d0(length)**2 for length in lens_ref.tolist()], device=device)[:, None, None]
+    lens_mobile_opt, lens_ref_opt = lens_mobile.to(device), lens_ref.to(device)
+    ref_sq_norms = (ref_coords_opt**2).sum(dim=-1)  # The reference never moves, so |b|^2 of the distance expansion is hoisted
+    mobile_mask_opt, ref_mask_opt = mobile_mask.to(device), ref_mask.to(device)
+
+    # Shapes are fixed for the whole run, so the compiled reward kernel is specialized once (dynamic=False)
+    reward_fn = torch.compile(get_reward_matrix, fullgraph=True, dynamic=False) if args.compile else get_reward_matrix
+    # TorchScript runs the op sequences of the per-step transform and Sinkhorn loop without going back through Python
+    transform_fn = torch.jit.script(get_transformation_matrix) if args.jit else get_transformation_matrix
+    sinkhorn_fn = torch.jit.script(sinkhorn_iterations) if args.jit else sinkhorn_iterations
+
+    transform_params = torch.zeros(num_pairs, 6, device=device, requires_grad=True)
+    optimizer = optim.AdamW([transform_params], lr=args.lr)
+
+    print("--- Finding Optimal Superposition (Sinkhorn Differentiable TM-score) ---")
+    final_P = None
+    score_history = []
+    support = None
+    # (step, scores) samples covering at least the last PLATEAU_WINDOW steps, taken at the print steps where the scores
+    # are already on the host; at least two samples, so a single one can never look like a plateau
+    recent_scores = collections.deque(maxlen=max(2, math.ceil(PLATEAU_WINDOW / args.print_freq) + 1))
+
+    score_kwargs = dict(cutoff=args.cutoff, steepness=args.steepness, gamma=args.gamma, sinkhorn_iters=args.sinkhorn_iters)
+
+    def get_dense_score(coords):
+        if args.numba and device.type == 'cpu':
+            return get_numba_sinkhorn_alignment_score(coords, ref_coords_opt, lens_mobile_opt, lens_ref_opt, inv_d0_sq_ref, **score_kwargs)
+        return get_sinkhorn_alignment_score(coords, ref_coords_opt, lens_ref_opt, inv_d0_sq_ref, mask=pair_mask, reward_fn=reward_fn,
+                                            sinkhorn_fn=sinkhorn_fn, coords_b_sq=ref_sq_norms, **score_kwargs)
+
+    for step in range(args.steps):
+        optimizer.zero_grad(set_to_none=True)
+        R, u = transform_fn(transform_params)
+        # One batched GEMM with the translation fused in as its bias (no separate matmul output to add u to)
+        transformed_mobile = torch.baddbmm(u[:, None, :], mobile_coords_opt, R.transpose(-1, -2))
+        if args.sparse_sinkhorn and step % args.print_freq == 0:
+            support = get_sinkhorn_support(transformed_mobile.detach(), ref_coords_opt, args.cutoff + args.sparse_margin, mask=pair_mask)
+        dense_step = support is None or step == args.steps - 1
+        if not dense_step:
+            score = get_sparse_sinkhorn_alignment_score(transformed_mobile, ref_coords_opt, lens_ref_opt, support, inv_d0_sq_ref,
+                                                        mask_a=mobile_mask_opt, mask_b=ref_mask_opt, **score_kwargs)
+        else:  # The last step is always dense so that the full alignment matrix P is available for decoding
+            score, P = get_dense_score(transformed_mobile)
+        loss = -score.sum()  # Each pair has its own parameters, so the summed loss optimizes them independently
+        if step % args.print_freq == 0 or step == args.steps - 1:
+            step_scores = score.detach().cpu()
+            score_history.append((step, step_scores))
+            if pairs is None:
+                print(f"Step {step:05d}: Sinkhorn Score = {step_scores[0]:.4f}")
+            else:
+                print(f"Step {step:05d}: Mean Sinkhorn Score over {num_pairs} pairs = {step_scores.mean():.4f}")
+            recent_scores.append((step, step_scores))
+            if args.plateau_tol > 0 and step >= PLATEAU_MIN_STEPS and step - recent_scores[0][0] >= PLATEAU_WINDOW:
+                window = torch.stack([scores for _, scores in recent_scores])
+                if ((window.max(dim=0).values - window.min(dim=0).values) < args.plateau_tol).all():
+                    # Stop before this step's update, so P and the final transform belong to the same parameters
+                    if not dense_step:
+                        with torch.no_grad():
+                            _, P = get_dense_score(transformed_mobile.detach())
+                    print(f"Score changed by less than {args.plateau_tol:g} over the last {PLATEAU_WINDOW} steps; stopping at step {step}.")
+                    break
+        loss.backward();
+        optimizer.step()
+    final_P = P.detach().cpu()
+    print("--- Global Search Finished ---\n")
+
+    mobile_coords_opt, ref_coords_opt = mobile_coords_opt.cpu(), ref_coords_opt.cpu()
+    R_final, u_final = get_transformation_matrix(transform_params.detach().clone().cpu())
+
+    for b in range(num_pairs):
+        len_mobile, len_ref = len(mobile_seqs[b]), len(ref_seqs[b])
+        pair_args = (mobile_paths[b], ref_paths[b], args.mobile_chain, mobile_coords_opt[b, :len_mobile], ref_coords_opt[b, :len_ref], ref_center[b],
+                     mobile_seqs[b], ref_seqs[b], R_final[b], u_final[b], final_P[b, :len_mobile, :len_ref])
+        if pairs is None:
+            report_alignment(*pair_args, output=args.output, matrix_out=args.matrix_out, parse_cache_dir=args.parse_cache_dir)
+            continue
+
+        # Batch mode: replay the per-pair progress so each log reads like a single-pair run.
+        pdb1, pdb2 = pairs[b]
+        log_file = None
+        output = matrix_out = None
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            output, matrix_out, log_path = pair_output_paths(args, pdb1, pdb2)
+            log_file = open(log_path, 'w')
+        with contextlib.redirect_stdout(log_file or sys.stdout):
+            # Each log gets the banner and timings of a single-pair run (as in run_pair), timed from the start of the joint batch
+            if log_file: print_banner(start_time)
+            else: print(f"\n========== Pair {b + 1}/{num_pairs}: {pdb1} vs {pdb2} ==========\n")
+            print_pair_header(mobile_paths[b], ref_paths[b], args.mobile_chain, args.reference_chain, len_mobile, len_ref)
+            print("--- Finding Optimal Superposition (Sinkhorn Differentiable TM-score) ---")
+            for step, step_scores in score_history:
+                print(f"Step {step:05d}: Sinkhorn Score = {step_scores[b]:.4f}")
+            print("--- Global Search Finished ---\n")
+            report_alignment(*pair_args, output=output, matrix_out=matrix_out, parse_cache_dir=args.parse_cache_dir)
+            if log_file:
+                end_time = datetime.datetime.now()
+                print(f"\nProgram finished at: {end_time.strftime('%Y-%m-%d %H:%M:%S')}\nTotal execution time: {end_time - start_time}")
+        if log_file:
+            log_file.close()
+            print(f"Pair {pdb1} vs {pdb2}: log, aligned structure and matrix saved to '{args.output_dir}'")
+    return num_pairs
+
+def run_pair(pair, args):
+    """Aligns one (mobile ID, reference ID) pair of --pair_file in a worker process and returns whether it was aligned and its output.
+    In --output_dir the log is written in the same format as a --mobile/--reference run, i.e. with banner and timings."""
+    # One thread per worker process to avoid oversubscribing the CPU cores (Numba's prange pool is sized separately)
+    torch.set_num_threads(1)
+    if njit is not None: numba.set_num_threads(1)
+    start_time = datetime.datetime.now()
+    pdb1, pdb2 = pair
+    pair_args = argparse.Namespace(**vars(args))
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        pair_args.output, pair_args.matrix_out, log_path = pair_output_paths(args, pdb1, pdb2)
+    else:
+        pair_args.output = pair_args.matrix_out = None
+
+    pair_output = io.StringIO()
+    with contextlib.redirect_stdout(pair_output):
+        aligned = align_pairs(pair_args, [os.path.join(args.pdb_dir, f"{pdb1}.pdb")], [os.path.join(args.pdb_dir, f"{pdb2}.pdb")]) > 0
+    if args.output_dir and aligned:  # Like the batched path, no log is written for a skipped pair
+        end_time = datetime.datetime.now()
+        with open(log_path, 'w') as f, contextlib.redirect_stdout(f):
+            print_banner(start_time)
+            print(pair_output.getvalue(), end="")
+            print(f"\nProgram finished at: {end_time.strftime('%Y-%m-%d %H:%M:%S')}\nTotal execution time: {end_time - start_time}")
+    return aligned, pair_output.getvalue()
+
+def main():
+    start_time = datetime.datetime.now()
+    parser = argparse.ArgumentParser(description="A custom tool for protein structure alignment.", formatter_class=argparse.RawTextHelpFormatter,
+        epilog="""    Author: Yue Hu (huyue@qlu.edu.cn)\n    Affiliation: Qilu University of Technology (Shandong Academy of Sciences)\n\n    Example Usage:\n      # Find the optimal superposition and save the matrix and superposed structure
+      python3 gemini_tm_align_final.py --mobile mobile.pdb --reference ref.pdb --matrix_out matrix.txt --output aligned.pdb
+      # Align all pairs of a pair list, writing per-pair logs and structures
+      # (one joint padded batch on a GPU, one pair per CPU core in worker processes otherwise)
+      python3 gemini_tm_align_final.py --pair_file RPIC_all/id_pair.txt --pdb_dir RPIC_all --output_dir batch_outputs
+      # Force the joint padded batch (or, with --workers N, N worker processes) whatever the device
+      python3 gemini_tm_align_final.py --pair_file RPIC_all/id_pair.txt --pdb_dir RPIC_all --output_dir batch_outputs --workers 1""")
+    parser.add_argument("--mobile", default=None, help="Path to the mobile PDB file.")
+    parser.add_argument("--reference", default=None, help="Path to the reference PDB file.")
+    parser.add_argument("--output", default=None, help="Path to save the aligned mobile PDB.")
+    parser.add_argument("--matrix_out", default=None, help="File to save the final transformation matrix.")
+    parser.add_argument("--mobile_chain", default=None, help="Chain ID for the mobile protein.")
+    parser.add_argument("--reference_chain", default=None, help="Chain ID for the reference protein.")
+    parser.add_argument("--pair_file", default=None, help="File of 'mobile reference' ID pairs to align (replaces --mobile/--reference); see --workers.")
+    parser.add_argument("--pdb_dir", default="RPIC_all", help="Directory containing <ID>.pdb files for --pair_file.")
+    parser.add_argument("--parse_cache_dir", default=None, help="Directory for .npz caches of parsed PDB files, reused by later runs while newer than the PDB.")
+    parser.add_argument("--output_dir", default=None, help="Directory for per-pair logs, aligned PDBs and matrices in --pair_file mode.")
+    parser.add_argument("--output_suffix", default=datetime.datetime.now().strftime('%m%d'), help="Suffix of the per-pair file names in --output_dir, as in run_batch_align*.sh\n(default: today's date as MMDD; empty for none).")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for --pair_file, each aligning one pair with a single CPU thread (0 = one per CPU core);\n1 aligns all pairs jointly as one batch padded to the longest proteins. The padded batch only pays off\non a GPU (on CPU the padding makes it slower than separate runs), so the default is 1 on CUDA, else 0.")
+    parser.add_argument("--steps", type=int, default=5000, help="Number of optimization steps.")
+    parser.add_argument("--lr", type=float, default=1e-3, help="Learning rate.")
+    parser.add_argument("--print_freq", type=int, default=100, help="Frequency of printing progress.")
+    parser.add_argument("--plateau_tol", type=float, default=0.0, help=f"Stop early once every pair's Sinkhorn score changed by less than this over the last {PLATEAU_WINDOW} steps\n(checked at print steps after step {PLATEAU_MIN_STEPS}; 0 = always run all --steps).")
+    parser.add_argument("--cutoff", type=float, default=7.0, help="Distance cutoff for sigmoid weight.")
+    parser.add_argument("--steepness", type=float, default=2.0, help="Steepness of the sigmoid cutoff.")
+    parser.add_argument("--gamma", type=float, default=20.0, help="Sharpness factor for Sinkhorn.")
+    parser.add_argument("--sinkhorn_iters", type=int, default=10, help="Number of Sinkhorn iterations.")
+    parser.add_argument("--sparse_sinkhorn", action="store_true", help="Evaluate the Sinkhorn score only on residue pairs within cutoff + sparse_margin,\nrefreshing that support every print_freq steps (dense fallback above 50%% density).")
+    parser.add_argument("--sparse_margin", type=float, default=4.0, help="Distance margin (in Angstrom) beyond the cutoff kept in the sparse Sinkhorn support.")
+    parser.add_argument("--compile", action="store_true", help="Fuse the distance/reward computation into one kernel with torch.compile\n(one-off compilation cost; pays off for long runs on large proteins).")
+    parser.add_argument("--numba", action="store_true", help="On CPU, compute the dense Sinkhorn score and its gradient with fused, multi-threaded Numba kernels\n(requires numba; first run pays the JIT compilation).")
+    parser.add_argument("--jit", action="store_true", help="Run the transformation and Sinkhorn iterations as TorchScript functions\n(cuts Python overhead on small proteins; deprecated upstream in favour of --compile).")
+    parser.add_argument("--device", default=None, help="Torch device for the optimization (default: cuda if available, else cpu).")
+    args = parser.parse_args()
+
+    if args.pair_file:
+        with open(args.pair_file, 'r') as f:
+            # Like run_batch_align*.sh, lines without both a mobile and a reference ID are skipped
+            pairs = [tokens[:2] for tokens in map(str.split, f) if len(tokens) >= 2]
+        mobile_paths = [os.path.join(args.pdb_dir, f"{pdb1}.pdb") for pdb1, _ in pairs]
+        ref_paths = [os.path.join(args.pdb_dir, f"{pdb2}.pdb") for _, pdb2 in pairs]
+    elif args.mobile and args.reference:
+        pairs = None
+        mobile_paths, ref_paths = [args.mobile], [args.reference]
+    else:
+        parser.error("either --mobile and --reference, or --pair_file, is required")
+    if args.numba and njit is None:
+        parser.error("--numba requires the numba package (pip install numba)")
+
+    if args.workers is None:
+        device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        args.workers = 1 if device.type == 'cuda' else 0
+
+    print_banner(start_time)
+
+    if args.pair_file and args.workers != 1:
+        with ProcessPoolExecutor(max_workers=args.workers or os.cpu_count()) as executor:
+            for (pdb1, pdb2), (aligned, log_text) in zip(pairs, executor.map(run_pair, pairs, itertools.repeat(args))):
+                if not aligned:
+                    print(f"Warning: could not parse {pdb1} or {pdb2}. Skipping this pair.")
+                elif args.output_dir:
+                    print(f"Pair {pdb1} vs {pdb2}: log, aligned structure and matrix saved to '{args.output_dir}'")
+                else:  # The run's own banner and timings frame the per-pair sections
+                    print(f"\n========== Pair {pdb1} vs {pdb2} ==========\n")
+                    print(log_text, end="")
+    else:
+        align_pairs(args, mobile_paths, ref_paths, pairs)
 
     end_time = datetime.datetime.now()
     print(f"\nProgram finished at: {end_time.strftime('%Y-%m-%d %H:%M:%S')}\nTotal execution time: {end_time - start_time}")
 
 if __name__ == '__main__':
     os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
-    main()
\ No newline at end of file
+    main()
@@ -1,4 +1,7 @@
 import os
+import shutil
+import subprocess
+import time
 
 # --- Configuration ---
 PAIR_FILE = "RPIC_all/id_pair.txt"
@@ -8,6 +11,7 @@ REFERENCE_DIR = "RPIC_all"
 PYMOL_SCRIPT_DIR = "pymol_scripts"
 IMAGE_DIR = "pymol_images"
 DATE = "0821"
+RENDER_WORKERS = os.cpu_count() or 1  # Parallel headless PyMOL processes, each ray tracing with a single thread
 
 def create_pymol_script(script_path, ref_pdb, mobile_pdb, image_path):
     ref_pdb_abs = os.path.abspath(ref_pdb)
@@ -15,8 +19,11 @@ def create_pymol_script(script_path, ref_pdb, mobile_pdb, image_path):
     image_path_abs = os.path.abspath(image_path)
     image_path_no_ext, _ = os.path.splitext(image_path_abs)
 
+    # reinitialize resets max_threads to the core count, so one ray-tracing thread per process is set after it:
+    # render_scripts runs one process per core instead
     content = f"""
 reinitialize
+set max_threads, 1
 bg_color white
 load {ref_pdb_abs}, reference
 load {mobile_pdb_abs}, mobile
@@ -34,6 +41,20 @@ png {image_path_no_ext}, width=800, height=600, dpi=300, ray=1
     with open(script_path, 'w') as f:
         f.write(content)
 
+def render_scripts(script_names, workers=RENDER_WORKERS):
+    """Renders the scripts with up to `workers` headless PyMOL processes running side by side.
+    Each process runs one interleaved chunk of the scripts, so PyMOL's startup is paid once per worker, not once per image."""
+    workers = max(1, min(workers, len(script_names)))
+    processes = []
+    for k in range(workers):
+        chunk_name = f"run_chunk_{k}.pml"
+        with open(os.path.join(PYMOL_SCRIPT_DIR, chunk_name), 'w') as f:
+            f.write("feedback disable, all, everything\nfeedback enable, all, errors\n")  # Quiet, but keep error messages
+            for script_name in script_names[k::workers]:
+                f.write(f"run {script_name}\n")
+        processes.append(subprocess.Popen(["pymol", "-cq", chunk_name], cwd=PYMOL_SCRIPT_DIR))
+    return [process.wait() for process in processes]
+
 def main():
     os.makedirs(PYMOL_SCRIPT_DIR, exist_ok=True)
     os.makedirs(IMAGE_DIR, exist_ok=True)
@@ -70,8 +91,24 @@ def main():
 
     print(f"Generated PyMOL scripts in '{PYMOL_SCRIPT_DIR}'")
     print(f"Images will be saved in '{IMAGE_DIR}'")
-    print("\nTo run the scripts, open a terminal and execute:")
-    print(f"pymol -c -d 'cd {os.path.abspath(PYMOL_SCRIPT_DIR)}; run run_all.pml'")
+
+    if shutil.which("pymol") is None or not all_scripts_to_run:
+        print("\nTo run the scripts, open a terminal and execute:")
+        print(f"pymol -c -d 'cd {os.path.abspath(PYMOL_SCRIPT_DIR)}; run run_all.pml'")
+        return
+
+    print(f"\nRendering {len(all_scripts_to_run)} images with {min(RENDER_WORKERS, len(all_scripts_to_run))} PyMOL processes...")
+    render_start = int(time.time())  # Whole seconds, for filesystems with coarse modification times
+    render_scripts(all_scripts_to_run)
+    # pymol -c usually exits 0 even when a script fails, so check for each expected (freshly written) image instead
+    missing = [image_name for image_name in (os.path.splitext(script_name)[0] + ".png" for script_name in all_scripts_to_run)
+               if not os.path.exists(os.path.join(IMAGE_DIR, image_name)) or os.path.getmtime(os.path.join(IMAGE_DIR, image_name)) < render_start]
+    if missing:
+        print(f"Warning: {len(missing)} image(s) were not rendered; see the PyMOL errors above:")
+        for image_name in missing:
+            print(f"  {os.path.join(IMAGE_DIR, image_name)}")
+    else:
+        print("Rendering finished.")
 
 if __name__ == "__main__":
     main()